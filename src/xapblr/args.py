@@ -2,8 +2,9 @@ from argparse import ArgumentParser, Action, BooleanOptionalAction
 from platform import node
 
 from .clip import clip_cmd
+from .compact import compact
 from .config import config
-from .index import index
+from .index import index, index_all
 from .list import list_cmd
 from .rebuild import rebuild
 from .render import renderers
@@ -41,6 +42,27 @@ index_parser = subparsers.add_parser(
     """,
 )
 index_parser.set_defaults(func=index)
+index_all_parser = subparsers.add_parser(
+    "index-all",
+    help="Incrementally index many blogs.",
+    description="""
+    Incrementally index many blogs in one process, sharing one API client and
+    one rate limit budget. Blogs whose latest indexed post is oldest are
+    updated first.
+    """,
+)
+index_all_parser.set_defaults(func=index_all)
+index_all_parser.add_argument(
+    "blogs",
+    metavar="BLOG",
+    nargs="*",
+    help="A blog to index. Default: all indexed blogs, if no --blogs-file.",
+)
+index_all_parser.add_argument(
+    "--blogs-file",
+    metavar="FILE",
+    help="Also index the blogs listed in %(metavar)s, one per line.",
+)
 search_parser = subparsers.add_parser(
     "search",
     help="""Search an indexed blog. For each match, prints the indexed JSON
@@ -62,9 +84,36 @@ rebuild_parser = subparsers.add_parser(
     """,
 )
 rebuild_parser.set_defaults(func=rebuild)
+compact_parser = subparsers.add_parser(
+    "compact",
+    help="Compact a local database.",
+    description="""Compact a local database.
+    Re-indexing leaves unused space in the database, which slows down searches.
+    Compacting rewrites it without; searches are unaffected in the meantime.
+    """,
+)
+compact_parser.set_defaults(func=compact)
 
-for p in [index_parser, search_parser, rebuild_parser]:
+for p in [index_parser, rebuild_parser, compact_parser]:
     p.add_argument("blog", metavar="BLOG", type=str, help="The blog to index.")
+search_parser.add_argument(
+    "blog",
+    metavar="BLOG",
+    type=str,
+    help="""
+    The blog to search. Several blogs can be searched together as a
+    comma-separated list; * searches all indexed blogs.
+    """,
+)
+
+rebuild_parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    metavar="N",
+    help="Rebuild with %(metavar)s processes. Default: the number of CPUs.",
+    default=None,
+)
 
 since_group = index_parser.add_mutually_exclusive_group()
 since_group.add_argument(
@@ -83,6 +132,14 @@ since_group.add_argument(
     post.
     """,
 )
+since_group.add_argument(
+    "--resume",
+    action="store_true",
+    help="""
+    Resume an interrupted index from the last checkpoint committed to the
+    database, without re-fetching the posts already indexed.
+    """,
+)
 index_parser.add_argument(
     "--until",
     action=StoreDateAction,
@@ -90,29 +147,39 @@ index_parser.add_argument(
     help="Re-index posts made until %(metavar)s. Default: now",
 )
 index_parser.add_argument(
-    "id",
-    nargs="*",
-    help=""" Explicitly re-index the post with this id.""",
-)
-index_parser.add_argument(
-    "--stemmer",
+    "--shard-by-year",
+    action="store_true",
     help="""
-    xapian stemmer to use for indexing.  If absent, posts are indexed verbatim.
-    See xapian docs
-    (https://xapian.org/docs/apidoc/html/classXapian_1_1Stem.html) for possible
-    values
+    Store the blog in one database per year of posts, so that updates only touch
+    the newest database and searches by date skip the others. Only possible
+    for blogs not yet indexed; sharded blogs stay sharded.
     """,
-    default=None,
 )
 index_parser.add_argument(
-    "--throttle",
-    action=BooleanOptionalAction,
-    default=True,
-    help="""
-    Whether to throttle requests to respect Tumblr's API rate limit (1000/hour
-    or 5000/calendar day, EST.)
-    """,
+    "id",
+    nargs="*",
+    help=""" Explicitly re-index the post with this id.""",
 )
+for p in [index_parser, index_all_parser]:
+    p.add_argument(
+        "--stemmer",
+        help="""
+        xapian stemmer to use for indexing.  If absent, posts are indexed verbatim.
+        See xapian docs
+        (https://xapian.org/docs/apidoc/html/classXapian_1_1Stem.html) for possible
+        values
+        """,
+        default=None,
+    )
+    p.add_argument(
+        "--throttle",
+        action=BooleanOptionalAction,
+        default=True,
+        help="""
+        Whether to throttle requests to respect Tumblr's API rate limit (1000/hour
+        or 5000/calendar day, EST.)
+        """,
+    )
 
 search_parser.add_argument(
     "--renderer",
@@ -122,7 +189,8 @@ search_parser.add_argument(
     approximate Tumblr's own rendering with increasing (but low, even for html)
     fidelity. Finally, embed queries Tumblr's OEmbed enpoint for the embedded
     HTML. It is therefore MUCH slower than formats that rely on locally cached
-    data and not suitable for large sets of matches.
+    data, at least until the embeds are cached, and not suitable for large
+    sets of matches.
     Default: %(default)s.
     """,
     default="json",
@@ -159,6 +227,25 @@ search_parser.add_argument(
     """,
     default=0,
 )
+search_parser.add_argument(
+    "--all",
+    action="store_true",
+    help="""
+    Output all matches, ignoring --limit. Matches are fetched and written in
+    chunks, so this works for any number of matches; with the json renderer
+    the output is NDJSON.
+    """,
+)
+search_parser.add_argument(
+    "--cursor",
+    metavar="CURSOR",
+    help="""
+    Page through results sorted by date with a cursor instead of an offset,
+    which is much faster deep into the results. Pass an empty string to start
+    from the beginning; the cursor for the next page is printed to stderr.
+    """,
+    default=None,
+)
 search_parser.add_argument(
     "--verbatim",
     action=BooleanOptionalAction,
@@ -0,0 +1,67 @@
+from sqlalchemy import delete, insert, select
+from xapian import DatabaseLockError, DocNotFoundError, TermGenerator
+
+from .db import db as sqldb
+from .models.caption import PendingCaption
+from .utils import get_db, get_unique_term, prefixes
+
+
+def pending_captions(s, blog, posts, caption):
+    # Queue caption to be added to posts (docids) of blog, in the session s.
+    if caption is None or len(posts) == 0:
+        return
+    rows = [{"blog": blog, "post_id": did, "caption": caption} for did in posts]
+    s.execute(insert(PendingCaption), rows)
+
+
+def apply_captions(dbs=None):
+    # Add pending captions to their posts, one commit per database. dbs maps
+    # names to databases already open for writing, to which captions are
+    # then limited; otherwise the databases are opened, skipping any that are
+    # locked by another writer. Their captions stay pending until next time.
+    if dbs is None:
+        with sqldb.session() as s:
+            blogs = s.scalars(select(PendingCaption.blog).distinct()).all()
+        for blog in blogs:
+            try:
+                db = get_db(blog, "w")
+            except DatabaseLockError:
+                continue
+            apply_blog_captions(blog, db)
+            db.close()
+    else:
+        for blog, db in dbs.items():
+            apply_blog_captions(blog, db)
+
+
+def apply_blog_captions(blog, db):
+    # Captions must only be read once the database is locked for writing, so
+    # that they are not applied twice by concurrent callers.
+    with sqldb.session() as s:
+        q = select(PendingCaption).where(PendingCaption.blog == blog)
+        pending = s.scalars(q).all()
+        if len(pending) == 0:
+            return
+        captions = {}
+        for c in pending:
+            captions.setdefault(c.post_id, []).append(c.caption)
+
+        tg = TermGenerator()
+        for did, cs in captions.items():
+            try:
+                doc = db.get_document(did)
+            except DocNotFoundError:
+                continue
+            tg.set_document(doc)
+            for caption in cs:
+                tg.index_text(caption, 1, prefixes["image"])
+            db.replace_document(get_unique_term(doc), doc)
+        db.commit()
+
+        ids = [c.id for c in pending]
+        chunk = 500
+        for i in range(0, len(ids), chunk):
+            s.execute(
+                delete(PendingCaption).where(PendingCaption.id.in_(ids[i : i + chunk]))
+            )
+        s.commit()
@@ -1,15 +1,20 @@
-from asyncio import gather, run, to_thread
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from multiprocessing import get_context
 from PIL import Image
-from queue import Queue
+from queue import Empty, Queue
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import JSONDecodeError, RequestException
 from signal import Signals, signal, SIGHUP, SIGINT, SIGTERM
 from sys import exit, stderr
-from tempfile import TemporaryFile
-from threading import Event
-from time import time, time_ns
+from urllib3.util.retry import Retry
+from threading import Condition, Event, Lock, Thread
+from time import sleep, time, time_ns
 
 from .config import config
+from .phash import MAX_LOOKUP, dhash
 
 
 class Captioner:
@@ -29,94 +34,236 @@ class Captioner:
         )
         self.model = self.model.to(self.device)
 
-        self.q = Queue()
+        # Images are decoded and transformed in worker processes, so that this
+        # does not hold up the model. They are spawned rather than forked,
+        # since this process may have initialised CUDA.
+        size = self.model.visual.image_size
+        size = max(size) if isinstance(size, tuple) else size
+        self.preprocess_args = (self.transform, size)
+        self.preprocessor = self.new_preprocessor()
+        self.preprocessor_lock = Lock()
+
+        self.downloader = ThreadPoolExecutor(config["clip_agent"]["download_workers"])
+        self.session = download_session()
+        # If set, a function returning, for each of a list of perceptual
+        # hashes, the caption of an image already captioned with a hash close
+        # to it, or None.
+        self.similar = None
+        # preprocessed images with a hash, to be looked up
+        self.hashed = Queue()
+        # preprocessed images, ready for captioning
         self.fs = Queue()
+        Thread(target=self.look_up_similar, daemon=True).start()
 
-    async def process_batch(self, tasks):
-        [self.q.put(t) for t in tasks]
-        self.n_tasks = len(tasks)
-        start = time_ns()
-        threads = [
-            to_thread(f)
-            for f in [
-                self.download_batch,
-                self.caption_batch,
-            ]
-        ]
-        tot_bs, _ = await gather(*threads)
-        t = (time_ns() - start) / 10**9
-        dtime, ctime = self.dtime / 10**9, self.ctime / 10**9
-        print(
-            f"Downloaded and captioned {len(tasks)} images ({int(tot_bs/1024)} KiB) in {t:.2f} s",
-            end=" ",
+    def new_preprocessor(self):
+        return ProcessPoolExecutor(
+            max_workers=config["clip_agent"]["preprocess_workers"],
+            mp_context=get_context("spawn"),
+            initializer=init_preprocess,
+            initargs=self.preprocess_args,
         )
-        print(f"({dtime:.2f} s downloading, {ctime:.2f} s captioning).")
-
-    def download_batch(self):
-        self.dtime = 0
-        tot_bs = 0
-        while not self.q.empty():
-            t = self.q.get()
-            print(f"Downloading {t['url']}...", end=" ", flush=True)
-            start = time_ns()
-            (bs, f) = self.download(t)
-            t["file"] = f
-            dt = time_ns() - start
-            dt_ms = int(dt / 10**6)
-            self.dtime += dt
-            tot_bs += bs
-            print(f"done ({int(bs/1024)} KiB, {dt_ms} ms).", flush=True)
-            self.fs.put(t)
-        return tot_bs
+
+    def add_task(self, t):
+        # Images go through download and preprocessing as soon as they are
+        # added, while earlier ones are being captioned.
+        f = self.downloader.submit(self.download, t)
+        f.add_done_callback(lambda f, t=t: self.downloaded(t, f))
+
+    # Every task added must end up on self.fs, failed if need be, or the
+    # agent would wait for it forever: the callbacks below catch anything.
+
+    def downloaded(self, t, future):
+        try:
+            (bs, data) = future.result()
+            print(f"Downloaded {t['url']} ({int(bs/1024)} KiB).", flush=True)
+            p = self.submit_preprocess(data)
+            p.add_done_callback(lambda p, t=t: self.preprocessed(t, p))
+        except Exception as e:
+            print(f"Error downloading {t['url']}: {e}.", flush=True)
+            self.failed(t, e)
+
+    def submit_preprocess(self, data):
+        # A worker process dying, e.g. killed for running out of memory,
+        # breaks the pool for good, so it is replaced.
+        with self.preprocessor_lock:
+            try:
+                return self.preprocessor.submit(preprocess_image, data)
+            except BrokenProcessPool:
+                print("Preprocessing pool broke, restarting it.", file=stderr)
+                self.preprocessor.shutdown(wait=False)
+                self.preprocessor = self.new_preprocessor()
+                return self.preprocessor.submit(preprocess_image, data)
 
     def download(self, task):
-        f = TemporaryFile()
-        r = requests.get(task["url"])
-        bs = len(r.content)
-        f.write(r.content)
-        return (bs, f)
-
-    def caption_batch(self):
-        self.ctime = 0
-        n_results = 0
-        while n_results < self.n_tasks:
-            t = self.fs.get()
-            print("Generating caption... ", end=" ", flush=True)
-            start = time_ns()
+        cfg = config["clip_agent"]
+        buf = BytesIO()
+        with self.session.get(
+            task["url"], stream=True, timeout=cfg["download_timeout"]
+        ) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(64 * 1024):
+                buf.write(chunk)
+        return (buf.tell(), buf.getvalue())
+
+    def preprocessed(self, t, future):
+        try:
+            (t["image"], t["phash"]) = future.result()
+            if t["phash"] is not None and self.similar is not None:
+                self.hashed.put(t)
+            else:
+                self.fs.put(t)
+        except Exception as e:
+            print(f"Error preprocessing {t['url']}: {e}.", flush=True)
+            self.failed(t, e)
+
+    def look_up_similar(self):
+        # Duplicates of images already captioned reuse their caption rather
+        # than going through the model. Hashes are looked up in batches, on
+        # this thread, so that lookups neither hold up nor wait on downloads.
+        cfg = config["clip_agent"]
+        while True:
+            ts = get_batch(self.hashed, cfg["micro_batch"], cfg["max_wait"], None)
             try:
-                self.caption(t)
+                captions = self.similar([t["phash"] for t in ts])
+                if len(captions) != len(ts):
+                    raise ValueError(f"{len(captions)} captions for {len(ts)} images")
+                for t, caption in zip(ts, captions):
+                    if caption is not None:
+                        del t["image"]
+                        t["duplicate"] = True
+                        t["caption"] = caption
+                        t["error"] = None
+                        t["success"] = True
             except Exception as e:
-                t["error"] = str(e)
-                t["success"] = False
-            else:
-                t["error"] = None
-                t["success"] = True
-            dt = time_ns() - start
-            dt_ms = int(dt / 10**6)
-            self.ctime += dt
-            n_results += 1
-            print(f"Done: {t['caption']} ({dt_ms} ms).", flush=True)
-
-    def preprocess(self, p):
-        im = Image.open(p).convert("RGB")
-        im = self.transform(im).unsqueeze(0)
-        im = im.to(self.device)
-        return im
-
-    def caption(self, t):
-        with self.torch.no_grad(), self.torch.cuda.amp.autocast():
-            im = self.preprocess(t["file"])
-            generated = self.model.generate(im, num_beam_groups=1)
-            caption = self.open_clip.decode(generated[0])
-        caption = (
-            caption[caption.index("<start_of_text>") + 15 :]
-            .replace("<end_of_text>", "")
-            .strip(" .")
-        )
-        if caption == "there is no image here to provide a caption for":
-            caption = None
-        t["caption"] = caption
-        del t["file"]
+                print(f"Error looking up similar images: {e}.", file=stderr)
+            [self.fs.put(t) for t in ts]
+
+    def failed(self, t, e):
+        t["image"] = None
+        t["error"] = str(e)
+        self.fs.put(t)
+
+    def caption_next(self, timeout):
+        # Caption the next micro-batch of images. Returns its tasks, or an empty
+        # list if no image is ready within timeout seconds. Captioning several
+        # images in one call to the model is much faster than one at a time.
+        cfg = config["clip_agent"]
+        ts = get_batch(self.fs, cfg["micro_batch"], cfg["max_wait"], timeout)
+        if len(ts) == 0:
+            return []
+
+        print(f"Generating {len(ts)} captions... ", end=" ", flush=True)
+        start = time_ns()
+        self.caption(ts)
+        dt_ms = int((time_ns() - start) / 10**6)
+        print(f"Done ({dt_ms} ms):", flush=True)
+        for t in ts:
+            print(f"    {t['caption'] if t['success'] else t['error']}")
+        return ts
+
+    def caption(self, ts):
+        ims = []
+        batch = []
+        for t in ts:
+            if t.get("duplicate", False):
+                continue
+            im = t.pop("image")
+            if im is None:
+                # the download or preprocessing failed
+                caption_failed(t, t["error"])
+                continue
+            ims.append(im)
+            batch.append(t)
+        if len(batch) == 0:
+            return
+
+        try:
+            ims = self.torch.stack(ims).to(self.device)
+            with self.torch.no_grad(), self.torch.cuda.amp.autocast():
+                generated = self.model.generate(ims, num_beam_groups=1)
+            captions = [self.open_clip.decode(g) for g in generated]
+        except Exception as e:
+            [caption_failed(t, e) for t in batch]
+            return
+        for t, caption in zip(batch, captions):
+            caption = (
+                caption[caption.index("<start_of_text>") + 15 :]
+                .replace("<end_of_text>", "")
+                .strip(" .")
+            )
+            if caption == "there is no image here to provide a caption for":
+                caption = None
+            t["caption"] = caption
+            t["error"] = None
+            t["success"] = True
+
+
+def get_batch(q, size, max_wait, timeout):
+    # Get up to size items from q, waiting up to timeout seconds for the first
+    # and, since items should not be waited on for long, at most max_wait
+    # seconds after it for the rest. Returns an empty list on timing out.
+    try:
+        items = [q.get(timeout=timeout)]
+    except Empty:
+        return []
+    deadline = time() + max_wait
+    while len(items) < size:
+        try:
+            items.append(q.get(timeout=max(deadline - time(), 0)))
+        except Empty:
+            break
+    return items
+
+
+preprocess_transform = None
+preprocess_size = None
+
+
+def init_preprocess(transform, size):
+    global preprocess_transform, preprocess_size
+    preprocess_transform = transform
+    preprocess_size = size
+
+
+def preprocess_image(data):
+    # Runs in a worker process. Large images are scaled down as early and as
+    # cheaply as possible: JPEGs are decoded at reduced size, and others
+    # reduced by an integer factor, to no less than twice the model's input
+    # size. The transform then takes care of the exact size.
+    im = Image.open(BytesIO(data))
+    target = 2 * preprocess_size
+    im.draft("RGB", (target, target))
+    im = im.convert("RGB")
+    factor = min(im.size) // target
+    if factor > 1:
+        im = im.reduce(factor)
+    # Images without any detail, e.g. plain colours, all hash to 0, so their
+    # hash does not identify them.
+    return (preprocess_transform(im), dhash(im) or None)
+
+
+def download_session():
+    # Connections are reused between downloads, with at most download_workers
+    # of them to any one host, and transient errors are retried.
+    cfg = config["clip_agent"]
+    retries = Retry(
+        total=cfg["download_retries"],
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(
+        pool_maxsize=cfg["download_workers"], pool_block=True, max_retries=retries
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def caption_failed(t, e):
+    t["caption"] = None
+    t["error"] = str(e)
+    t["success"] = False
 
 
 def get_tasks(endpoint, token, agent):
@@ -127,16 +274,166 @@ def get_tasks(endpoint, token, agent):
     r.raise_for_status()
     try:
         data = r.json()
-        return (data["available"], data["images"])
+        return (data["available"], data["images"], data["lease"])
     except KeyError as e:
         raise ValueError(f"Invalid response from server: {e}")
     except JSONDecodeError as e:
         raise ValueError(f"Malformed JSON: {e}")
 
 
+class Leases:
+    """
+    The batches of tasks leased by the agent and not yet captioned, by lease
+    token. Their leases are renewed until all their tasks are captioned, or
+    for at most clip_agent.lease_limit seconds, after which the batch is given
+    up on, so that a lost task does not keep the agent waiting forever.
+    """
+
+    def __init__(self, endpoint, token):
+        self.endpoint = endpoint
+        self.token = token
+        self.cond = Condition()
+        self.remaining = {}
+        self.done = {}
+        self.added = {}
+
+    def add(self, lease, tasks):
+        with self.cond:
+            self.remaining[lease["token"]] = len(tasks)
+            self.done[lease["token"]] = done = Event()
+            self.added[lease["token"]] = time()
+        for t in tasks:
+            t["lease"] = lease["token"]
+        Thread(
+            target=renew_lease,
+            args=(self.endpoint, self.token, lease, done),
+            daemon=True,
+        ).start()
+
+    def finish(self, t):
+        with self.cond:
+            if t["lease"] not in self.remaining:
+                # given up on
+                return
+            self.remaining[t["lease"]] -= 1
+            if self.remaining[t["lease"]] == 0:
+                self.release(t["lease"])
+
+    def release(self, lease):
+        # with self.cond held
+        del self.remaining[lease]
+        del self.added[lease]
+        self.done.pop(lease).set()
+        self.cond.notify_all()
+
+    def expire(self):
+        # with self.cond held
+        limit = time() - config["clip_agent"]["lease_limit"]
+        for lease in [k for k, v in self.added.items() if v < limit]:
+            n = self.remaining[lease]
+            print(f"Giving up on {n} tasks after lease_limit.", file=stderr)
+            self.release(lease)
+
+    def wait_below(self, n, quit_ev):
+        # Wait until fewer than n batches are leased.
+        with self.cond:
+            self.expire()
+            while len(self.remaining) >= n and not quit_ev.is_set():
+                self.cond.wait(1)
+                self.expire()
+
+    def __len__(self):
+        with self.cond:
+            self.expire()
+            return len(self.remaining)
+
+
+def renew_lease(endpoint, token, lease, done):
+    # Renew the lease on a batch of tasks until done is set, so that the server
+    # does not offer them to other agents while they take long to caption.
+    while not done.wait(lease["timeout"] / 2):
+        try:
+            r = requests.post(
+                f"{endpoint}/renew",
+                json={"auth_token": token, "lease": lease["token"]},
+            )
+            r.raise_for_status()
+        except RequestException as e:
+            print(f"Error renewing lease: {e}.", file=stderr)
+
+
+def find_similar(session, endpoint, token, phashes):
+    captions = []
+    for i in range(0, len(phashes), MAX_LOOKUP):
+        r = session.post(
+            f"{endpoint}/similar",
+            json={"auth_token": token, "phashes": phashes[i : i + MAX_LOOKUP]},
+            timeout=config["clip_agent"]["download_timeout"],
+        )
+        r.raise_for_status()
+        captions += r.json()["captions"]
+    return captions
+
+
 def submit_captions(endpoint, token, agent, tasks):
+    # Failed submissions are retried, since the tasks would otherwise be
+    # captioned again once their lease expires.
     data = {"auth_token": token, "agent": agent, "images": tasks}
-    requests.post(endpoint, json=data)
+    retries = config["clip_agent"]["submit_retries"]
+    for attempt in range(retries + 1):
+        try:
+            r = requests.post(endpoint, json=data)
+            r.raise_for_status()
+            return
+        except RequestException as e:
+            print(f"Error submitting captions: {e}.", file=stderr)
+            if attempt < retries:
+                sleep(min(2**attempt, 60))
+    print(f"Giving up on submitting {len(tasks)} captions.", file=stderr)
+
+
+def fetch_tasks(endpoint, token, agent, cptnr, leases, quit_ev, sleep):
+    # Lease batches of tasks and hand them to the captioner, keeping up to
+    # clip_agent.prefetch batches leased ahead of the one being captioned, so
+    # that the model need not wait for the server or for downloads.
+    while not quit_ev.is_set():
+        leases.wait_below(config["clip_agent"]["prefetch"] + 1, quit_ev)
+        if quit_ev.is_set():
+            break
+        print("Fetching tasks...")
+        try:
+            (available, tasks, lease) = get_tasks(endpoint, token, agent)
+        except RequestException as e:
+            print(f"Error fetching tasks: {e}. Retrying in {sleep} s.", file=stderr)
+            quit_ev.wait(sleep)
+            continue
+        except ValueError as e:
+            print(f"Bad response from server: {e}. Retrying in {sleep} s.", file=stderr)
+            quit_ev.wait(sleep)
+            continue
+        print(f"There are {len(tasks)} tasks in this batch out of {available} total.")
+
+        if len(tasks) > 0:
+            leases.add(lease, tasks)
+            [cptnr.add_task(t) for t in tasks]
+        if available - len(tasks) == 0:
+            print(f"No more images in queue for now. Sleeping for {sleep} s.")
+            quit_ev.wait(sleep)
+
+
+def submit_results(endpoint, token, agent, results, stop):
+    # Submit captioned tasks as they come in, until stop is set and all have
+    # been submitted.
+    while True:
+        try:
+            tasks = [results.get(timeout=1)]
+        except Empty:
+            if stop.is_set():
+                return
+            continue
+        while not results.empty():
+            tasks.append(results.get())
+        submit_captions(endpoint, token, agent, tasks)
 
 
 def clip_cmd(args):
@@ -160,6 +457,9 @@ def clip_cmd(args):
     print(f"Loaded model onto GPU in {dt:.2f} s.")
 
     token = config["clip"]["auth_token"]
+    # lookups reuse their connection to the server
+    session = requests.Session()
+    cptnr.similar = lambda phashes: find_similar(session, endpoint, token, phashes)
     quit_ev = Event()
 
     def quit_f(signo, _frame):
@@ -169,30 +469,25 @@ def clip_cmd(args):
 
     [signal(sig, quit_f) for sig in [SIGHUP, SIGINT, SIGTERM]]
 
-    while not quit_ev.is_set():
-        print("Fetching tasks...", end=" ")
-        fetch_success = False
-        try:
-            (available, tasks) = get_tasks(endpoint, token, agent)
-        except RequestException as e:
-            print(f"Error fetching tasks: {e}.", file=stderr, end=" ")
-        except ValueError as e:
-            print(f"Bad response from server: {e}.", file=stderr, end=" ")
-        else:
-            print(
-                f"There are {len(tasks)} tasks in this batch out of {available} total."
-            )
-            fetch_success = True
-
-        if not fetch_success:
-            print(f"Retrying in {sleep} s.", file=stderr)
-            quit_ev.wait(sleep)
-            continue
-
-        if len(tasks) > 0:
-            run(cptnr.process_batch(tasks))
-            submit_captions(endpoint, token, agent, tasks)
+    # Fetching, captioning and submitting run concurrently. On quitting, no
+    # more tasks are fetched, but those already leased are finished.
+    leases = Leases(endpoint, token)
+    results = Queue()
+    stop = Event()
+    fetcher = Thread(
+        target=fetch_tasks,
+        args=(endpoint, token, agent, cptnr, leases, quit_ev, sleep),
+        daemon=True,
+    )
+    submitter = Thread(
+        target=submit_results, args=(endpoint, token, agent, results, stop)
+    )
+    fetcher.start()
+    submitter.start()
 
-        if available - len(tasks) == 0:
-            print(f"No more images in queue for now. Sleeping for {sleep} s.")
-            quit_ev.wait(sleep)
+    while fetcher.is_alive() or len(leases) > 0:
+        for t in cptnr.caption_next(timeout=1):
+            leases.finish(t)
+            results.put(t)
+    stop.set()
+    submitter.join()
@@ -0,0 +1,43 @@
+from shutil import rmtree
+from xapian import DBCOMPACT_NO_RENUMBER
+
+from .shards import get_shards
+from .utils import get_db, get_db_path, swap_db
+
+
+def compact(args):
+    for (name, _) in get_shards(args.blog):
+        print(f"Compacting {name}... ", end="", flush=True)
+        compact_db(name, get_db(name, "w"))
+
+
+def compact_db(name, db):
+    # db must be open for writing, which keeps any other writer out until the
+    # compacted copy is swapped in; its changes would otherwise be lost.
+    # Readers keep using the old database until then. Closes db.
+    path = get_db_path(name)
+    tmp = path.with_name(f".{path.name}.compact")
+    rmtree(tmp, ignore_errors=True)
+
+    # the compacted copy starts counting afresh
+    reset_commits(db)
+    db.commit()
+    size = get_size(path)
+    # docids are preserved, since images_in_posts refers to them
+    db.compact(str(tmp), DBCOMPACT_NO_RENUMBER)
+    swap_db(path, tmp)
+    db.close()
+    print(f"{size >> 20} MiB -> {get_size(path) >> 20} MiB")
+
+
+def get_commits(db):
+    # The number of commits by index since the database was last compacted.
+    return int(db.get_metadata("commits") or 0)
+
+
+def reset_commits(db):
+    db.set_metadata("commits", "")
+
+
+def get_size(path):
+    return sum(f.stat().st_size for f in path.iterdir() if f.is_file())
@@ -1,25 +1,64 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import Session
 
 from .config import config
 from .models.base import Base
+from .models import caption, image, oembed, trail  # noqa: F401
 from .utils import get_db_dir
 
 
 class Database:
     def __init__(self, echo=False):
         db_path = (get_db_dir() / "xapblr.sqlite3").resolve()
+        exists = db_path.exists()
         self.engine = create_engine(f"sqlite:///{db_path}", echo=echo)
-        if not db_path.exists():
+        event.listen(self.engine, "connect", set_pragmas)
+        if not exists:
             print(
                 f"Database file {db_path} does not exist. Creating and populating... ",
                 end="",
             )
-            Base.metadata.create_all(self.engine)
+        # Also creates any tables added since the database was created.
+        Base.metadata.create_all(self.engine)
+        migrate(self.engine)
+        if not exists:
             print("Done.")
 
     def session(self):
         return Session(self.engine)
 
 
+def set_pragmas(conn, record):
+    # WAL lets readers (e.g. CLIP agents polling the server) proceed while an
+    # index writes, and writers wait for each other rather than failing with
+    # "database is locked". synchronous=NORMAL is safe in WAL mode.
+    cfg = config["sqlite"]
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute(f"PRAGMA busy_timeout={int(cfg['busy_timeout'])}")
+    cur.execute(f"PRAGMA cache_size={-1024 * int(cfg['cache_mib'])}")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.close()
+
+
+def migrate(engine):
+    # create_all does not add columns or indexes to tables that already exist.
+    # Columns added to existing tables must be nullable.
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                col_type = col.type.compile(dialect=engine.dialect)
+                conn.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {col.name} {col_type}")
+                )
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 db = Database(echo=config.get("debug", False))
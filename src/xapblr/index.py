@@ -1,31 +1,39 @@
+from argparse import Namespace
 from time import time
 from datetime import datetime
-from json import dumps
+from json import dumps, loads
 from math import ceil
 import pytumblr2 as pytumblr
+from pytumblr2.request import TumblrRequest
+from requests import Session
+from requests.exceptions import TooManyRedirects
 from sqlalchemy import select
-from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects.sqlite import insert
 import sys
+from queue import Full, Queue
+from threading import Event, Thread
 from xapian import (
-    DocNotFoundError,
     Document,
     Stem,
     TermGenerator,
     sortable_serialise,
 )
 
-from time import sleep
-
-from urllib.parse import urlparse
+from urllib.parse import urlencode, urlparse
 
+from .captions import apply_captions, pending_captions
+from .compact import compact_db, get_commits
 from .config import config
 from .models.image import Image, ImageState, ImageInPost
 from .db import db as sqldb
+from .ratelimit import RateLimiter
+from .storage import encode_post, store_trails, trail_key
+from .list import list_blogs
 from .search import get_latest
+from .shards import BlogWriter, init_sharded, is_sharded
 from .utils import (
+    LRUCache,
     get_author,
-    get_db,
-    get_unique_term,
     encode_tag,
     format_timestamp,
     prefixes,
@@ -107,11 +115,42 @@ def index_content(post, tg, out_data):
     doc.add_term(prefixes["author"] + get_author(post))
 
 
-def index_post(post, tg):
+def index_trail(trail, key, tg, out_data, trail_cache):
+    # Trail entries recur in every reblog of a post; index each one once into
+    # a scratch document and copy its terms into every post it appears in.
+    doc = tg.get_document()
+    termpos = tg.get_termpos()
+    cached = trail_cache.get(key) if trail_cache is not None else None
+    if cached is not None:
+        (terms, span, images) = cached
+    else:
+        scratch = Document()
+        tg.set_document(scratch)
+        scratch_data = {"images": {}}
+        index_content(trail, tg, scratch_data)
+        terms = [(t.term, t.wdf, list(t.positer)) for t in scratch.termlist()]
+        span = tg.get_termpos()
+        images = scratch_data["images"]
+        tg.set_document(doc)
+        if trail_cache is not None:
+            trail_cache[key] = (terms, span, images)
+        out_data["trails"][key] = trail
+
+    for term, wdf, positions in terms:
+        for pos in positions:
+            doc.add_posting(term, termpos + pos)
+        if wdf > len(positions):
+            doc.add_term(term, wdf - len(positions))
+    tg.set_termpos(termpos + span)
+    for k, v in images.items():
+        out_data["images"][k] = dict(v)
+
+
+def index_post(post, tg, trail_cache=None):
     doc = Document()
     tg.set_document(doc)
     # data for post-processing after seeing the whole post
-    out_data = {"images": {}}
+    out_data = {"images": {}, "trails": {}}
 
     if len(post["trail"]) > 0:
         op = get_author(post["trail"][0])
@@ -119,15 +158,19 @@ def index_post(post, tg):
         op = post["blog"]["name"]
     doc.add_term(prefixes["op"] + op)
 
+    trail_keys = []
     for t in post["trail"]:
-        index_content(t, tg, out_data)
+        key = trail_key(t)
+        index_trail(t, key, tg, out_data, trail_cache)
+        trail_keys.append(key)
     index_content(post, tg, out_data)
 
     for t in post["tags"]:
         doc.add_term(encode_tag(t))
 
     doc.add_value(value_slots["timestamp"], sortable_serialise(post["timestamp"]))
-    doc.set_data(dumps(post))
+    # trail entries are stored separately, see store_trails
+    doc.set_data(encode_post(dict(post, trail=trail_keys)))
 
     id_term = "Q" + str(post["id"])
     doc.add_boolean_term(id_term)
@@ -135,13 +178,85 @@ def index_post(post, tg):
     return (id_term, doc, out_data)
 
 
-def index(args):
+class PooledRequest(TumblrRequest):
+    # pytumblr opens a new connection for every request; keep them alive in a
+    # session instead.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = Session()
+
+    def get(self, url, params):
+        url = self.host + url
+        if params:
+            url = url + "?" + urlencode(params)
+
+        try:
+            resp = self.session.get(
+                url, allow_redirects=False, headers=self.headers, auth=self.oauth
+            )
+        except TooManyRedirects as e:
+            resp = e.response
+
+        return self.json_parse(resp)
+
+
+def get_client():
     try:
         api_key = config["api_key"]
     except KeyError:
         sys.exit("No API key configured. Exiting.")
 
     client = pytumblr.TumblrRestClient(**api_key)
+    client.request = PooledRequest(**api_key)
+    return client
+
+
+def index(args):
+    client = get_client()
+    limiter = RateLimiter(enabled=args.throttle)
+    index_blog(client, limiter, args)
+
+
+def index_all(args):
+    blogs = list(args.blogs)
+    if args.blogs_file is not None:
+        with open(args.blogs_file) as f:
+            for line in f:
+                line = line.split("#")[0].strip()
+                if line:
+                    blogs.append(line)
+    if len(blogs) == 0:
+        blogs = [b["name"] for b in list_blogs(args)]
+
+    # Update the stalest blogs first; blogs never indexed are stalest of all.
+    latest = {b: get_latest(b) or 0 for b in set(blogs)}
+    blogs = sorted(latest.keys(), key=lambda b: latest[b])
+
+    client = get_client()
+    limiter = RateLimiter(enabled=args.throttle)
+    failed = []
+    for blog in blogs:
+        blog_args = Namespace(
+            blog=blog,
+            full=False,
+            resume=False,
+            since=None,
+            until=None,
+            shard_by_year=False,
+            stemmer=args.stemmer,
+            throttle=args.throttle,
+        )
+        try:
+            index_blog(client, limiter, blog_args)
+        except Exception as e:
+            print()
+            print(f"Error indexing {blog}: {e}", file=sys.stderr)
+            failed.append(blog)
+    if failed:
+        sys.exit(f"Failed to index {len(failed)} of {len(blogs)} blogs.")
+
+
+def index_blog(client, limiter, args):
     kwargs = {}
     if args.until is not None:
         kwargs["before"] = args.until
@@ -149,14 +264,49 @@ def index(args):
     n = 0
     print(f"Indexing {args.blog}... ", end="")
     try:
-        blog = client.blog_info(args.blog)["blog"]
+        blog = limiter.call(client.blog_info, args.blog)["blog"]
     except KeyError:
         print(client.blog_info(args.blog))
         print("Blog does not exist or API key owner is blocked by it.", file=sys.stderr)
         # TODO: this should probably throw instead
         return
+
+    if args.shard_by_year and not is_sharded(args.blog):
+        if get_latest(args.blog) is not None:
+            print()
+            sys.exit(
+                f"{args.blog} is already indexed without shards; "
+                "delete its database to re-index it sharded."
+            )
+        init_sharded(args.blog)
+
+    db = BlogWriter(args.blog)
+    tg = TermGenerator()
+    if args.stemmer is not None:
+        tg.set_stemmer(Stem(args.stemmer))
+    trail_cache = LRUCache(config["index"]["trail_cache"])
+
+    page = 0
+    images = {}
     full = False
-    if args.full:
+    if args.resume:
+        checkpoint = get_checkpoint(db)
+        if checkpoint is None:
+            print()
+            sys.exit("No checkpoint to resume from.")
+        kwargs["before"] = checkpoint["before"]
+        args.since = checkpoint["since"]
+        full = checkpoint["full"]
+        page = checkpoint["pages"]
+        n = checkpoint["n"]
+        print(
+            f"Resuming from checkpoint after {n} posts, "
+            f"at {format_timestamp(kwargs['before'])}..."
+        )
+        # images from the last committed page may not have been queued
+        queue_shard_images(checkpoint["images"])
+        clear_checkpoint_images(db, checkpoint)
+    elif args.full:
         print("Performing full re-index...")
         full = True
     else:
@@ -169,101 +319,208 @@ def index(args):
             if args.since is None:
                 args.since = latest_ts
 
-    db = get_db(args.blog, "w")
-    tg = TermGenerator()
-    if args.stemmer is not None:
-        tg.set_stemmer(Stem(args.stemmer))
-
     fetch = True
     if args.since is not None and args.since >= blog["updated"]:
         print(f'No new posts since {format_timestamp(blog["updated"])}', end="")
         fetch = False
 
-    throttle = 3600 / 1000
     if args.throttle and full:
-        count = blog["posts"]
-        reqs = ceil(count / 20)
         # rate limit: 5000 requests per calendary day (EST) or 1000 requests
-        # per hour.
-        daily_limit = 5000
-        if reqs >= daily_limit:
+        # per hour, shared with any other running xapblr processes.
+        throttle = 3600 / limiter.hourly
+        count = blog["posts"]
+        reqs = ceil(count / 20) - page
+        if reqs >= limiter.daily:
             print(
-                f"Blog has {count} posts, need {reqs} requests; throttling down to {daily_limit} / day."
+                f"Blog has {count} posts, need {reqs} requests; throttling down to {limiter.daily} / day."
             )
-            throttle = 3600 * 24 / daily_limit
+            throttle = 3600 * 24 / limiter.daily
         eta = time() + reqs * throttle
         eta_hf = format_timestamp(eta)
         eta_locale = datetime.fromtimestamp(eta).strftime("%c")
         print(f"ETA: {eta_hf} ({eta_locale})")
-    if not args.throttle:
-        throttle = 0
-
-    pages = 1
-    commit_every = 10
-    images = {}
-    while fetch:
-        response = client.posts(args.blog, npf=True, **kwargs)
-        posts = response["posts"]
 
-        if len(posts) == 0:
-            break
-        n += len(posts)
-
-        for p in posts:
-            (id_term, post_doc, out_data) = index_post(p, tg)
-            did = db.replace_document(id_term, post_doc)
-            append_images(images, out_data, did)
-            kwargs["before"] = p["timestamp"]
-
-        if pages % commit_every == 0:
-            print("*", end="", flush=True)
-            db.commit()
-            queue_images(db, images, args.blog)
-            images = {}
-        else:
-            print(".", end="", flush=True)
-        if "_links" not in response.keys():
-            break
-        if args.since is not None and args.since >= kwargs["before"]:
-            break
-
-        pages += 1
-        sleep(throttle)
+    commit_every = config["index"]["commit_every"]
+    pages = Queue(maxsize=config["index"]["prefetch"])
+    stop = Event()
+    if fetch:
+        fetcher = Thread(
+            target=fetch_pages,
+            args=(client, args.blog, kwargs, args.since, limiter, pages, stop),
+            daemon=True,
+        )
+        fetcher.start()
+    else:
+        pages.put(None)
 
-    queue_images(db, images, args.blog)
+    before = kwargs.get("before", None)
+    try:
+        while True:
+            posts = pages.get()
+            if posts is None:
+                break
+            if isinstance(posts, Exception):
+                raise posts
+            page += 1
+            n += len(posts)
+
+            indexed = [index_post(p, tg, trail_cache) for p in posts]
+            # Trails are stored before any document referencing them is
+            # written, not at the next commit: xapian also commits pending
+            # documents when the database is closed, e.g. if indexing fails.
+            store_trails({k: t for i in indexed for k, t in i[2]["trails"].items()})
+            for p, (id_term, post_doc, out_data) in zip(posts, indexed):
+                (shard, shard_db) = db.shard(p["timestamp"])
+                did = shard_db.replace_document(id_term, post_doc)
+                append_images(images.setdefault(shard, {}), out_data, did)
+                before = p["timestamp"]
+
+            if page % commit_every == 0:
+                print("*", end="", flush=True)
+                checkpoint = {
+                    "before": before,
+                    "since": args.since,
+                    "full": full,
+                    "pages": page,
+                    "n": n,
+                    "images": images,
+                }
+                set_checkpoint(db, checkpoint)
+                db.commit()
+                queue_shard_images(images)
+                clear_checkpoint_images(db, checkpoint)
+                apply_captions(db.dbs)
+                images = {}
+            else:
+                print(".", end="", flush=True)
+    finally:
+        stop.set()
+
+    queue_shard_images(images)
+    set_checkpoint(db, None)
+    db.commit()
+    apply_captions(db.dbs)
     print()
     print(f"Done; indexed {n} posts.")
 
+    compact_every = config["index"]["compact_every"]
+    for shard, shard_db in db.dbs.items():
+        if compact_every > 0 and get_commits(shard_db) >= compact_every:
+            print(f"Compacting {shard}... ", end="", flush=True)
+            compact_db(shard, shard_db)
+
+
+def get_checkpoint(db):
+    # The checkpoint is committed together with (or, for a sharded blog, right
+    # after) the posts it covers, so a crashed index can be resumed without
+    # re-fetching them.
+    data = db.get_metadata("checkpoint")
+    if not data:
+        return None
+    return loads(data)
+
+
+def set_checkpoint(db, checkpoint):
+    if checkpoint is None:
+        db.set_metadata("checkpoint", "")
+    else:
+        db.set_metadata("checkpoint", dumps(checkpoint))
+
+
+def clear_checkpoint_images(db, checkpoint):
+    # Once queued, images are dropped from the checkpoint: queueing them again
+    # on resuming would add the captions of known images to their posts twice.
+    checkpoint["images"] = {}
+    set_checkpoint(db, checkpoint)
+    db.commit()
+
+
+def fetch_pages(client, blog, kwargs, since, limiter, pages, stop):
+    # Producer half of index(): fetch pages of posts into the queue pages while
+    # the caller indexes them, so that throttling overlaps with indexing.
+    # Puts None on the queue when done, preceded by the exception if one
+    # occured. Gives up as soon as stop is set, even if the queue is full.
+    try:
+        while not stop.is_set():
+            response = limiter.call(client.posts, blog, npf=True, **kwargs)
+            posts = response["posts"]
+
+            if len(posts) == 0:
+                break
+            if not put_unless_stopped(pages, posts, stop):
+                return
+            kwargs["before"] = posts[-1]["timestamp"]
+
+            if "_links" not in response.keys():
+                break
+            if since is not None and since >= kwargs["before"]:
+                break
+    except Exception as e:
+        if not put_unless_stopped(pages, e, stop):
+            return
+    put_unless_stopped(pages, None, stop)
+
+
+def put_unless_stopped(q, item, stop):
+    # Put item on q, unless stop is set while waiting for room. Returns
+    # whether it was put.
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def queue_shard_images(images):
+    # images maps the name of each database written to the images in its posts.
+    for shard, imgs in images.items():
+        queue_images(imgs, shard)
 
-def queue_images(db, imgs, blog):
+
+def queue_images(imgs, blog):
+    # Queue new images for captioning, and the captions of known images to be
+    # added to the posts; see captions.apply_captions. Rows that already exist
+    # are left alone by the database, rather than looked up one by one.
+    if len(imgs) == 0:
+        return
+    chunk = 500
+    now = int(time())
     with sqldb.session() as s:
-        existing_imgs_q = (
-            select(Image)
-            .options(joinedload(Image.posts))
-            .where(Image.media_key.in_(imgs.keys()))
-        )
-        img_objs = {}
-        tg = TermGenerator()
-        for img in s.scalars(existing_imgs_q).unique():
-            ps = [(p.blog, p.post_id) for p in img.posts]
-            for did in imgs[img.media_key]["posts"]:
-                if (blog, did) not in ps:
-                    img.posts.append(ImageInPost(blog=blog, post_id=did, image=img))
-                add_caption_to_doc(db, did, tg, img.caption)
-            img_objs[img.media_key] = img
-
-        new_img_objs = [
-            Image(
-                media_key=v["media_key"],
-                url=v["url"],
-                state=ImageState.AVAILABLE,
-                created=int(time()),
-                posts=[ImageInPost(blog=blog, post_id=did) for did in v["posts"]],
-            )
+        rows = [
+            {
+                "media_key": k,
+                "url": v["url"],
+                "state": ImageState.AVAILABLE,
+                "created": now,
+            }
             for k, v in imgs.items()
-            if k not in img_objs.keys()
         ]
-        s.add_all(new_img_objs)
+        for i in range(0, len(rows), chunk):
+            stmt = insert(Image).values(rows[i : i + chunk]).on_conflict_do_nothing()
+            s.execute(stmt)
+
+        found = {}
+        keys = list(imgs.keys())
+        for i in range(0, len(keys), chunk):
+            q = select(Image.id, Image.media_key, Image.caption).where(
+                Image.media_key.in_(keys[i : i + chunk])
+            )
+            for img_id, key, caption in s.execute(q):
+                found[key] = (img_id, caption)
+
+        links = []
+        for k, v in imgs.items():
+            (img_id, caption) = found[k]
+            posts = sorted(set(v["posts"]))
+            links += [{"image_id": img_id, "blog": blog, "post_id": p} for p in posts]
+            pending_captions(s, blog, posts, caption)
+        for i in range(0, len(links), chunk):
+            stmt = (
+                insert(ImageInPost).values(links[i : i + chunk]).on_conflict_do_nothing()
+            )
+            s.execute(stmt)
         s.commit()
 
 
@@ -274,16 +531,3 @@ def append_images(images, out_data, did):
         else:
             images[k] = v
             images[k]["posts"] = [did]
-
-
-def add_caption_to_doc(db, did, tg, caption):
-    if caption is None:
-        return
-    try:
-        doc = db.get_document(did)
-    except DocNotFoundError:
-        return
-    id_term = get_unique_term(doc)
-    tg.set_document(doc)
-    tg.index_text(caption, 1, prefixes["image"])
-    db.replace_document(id_term, doc)
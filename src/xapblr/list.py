@@ -1,5 +1,5 @@
 from xapian import Database
-from .utils import get_db_dir, format_timestamp
+from .utils import get_db_path, format_timestamp, list_blog_names
 from .search import get_latest, get_earliest
 
 
@@ -15,18 +15,17 @@ def list_cmd(args):
 
 
 def list_blogs(args):
-    for child in get_db_dir().iterdir():
-        if child.is_dir():
-            try:
-                db = Database(str(child))
-            except Exception:
-                continue
-            count = db.get_doccount()
-            latest_ts = get_latest(db)
-            earliest_ts = get_earliest(db)
-            yield {
-                "name": child.name,
-                "count": count,
-                "latest": latest_ts,
-                "earliest": earliest_ts,
-            }
+    for name in list_blog_names():
+        try:
+            db = Database(str(get_db_path(name)))
+        except Exception:
+            continue
+        count = db.get_doccount()
+        latest_ts = get_latest(db)
+        earliest_ts = get_earliest(db)
+        yield {
+            "name": name,
+            "count": count,
+            "latest": latest_ts,
+            "earliest": earliest_ts,
+        }
@@ -0,0 +1,18 @@
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class PendingCaption(Base):
+    # Image captions waiting to be added to the documents of the posts they
+    # appear in, see captions.apply_captions. blog is the name of the database
+    # (see utils.get_db) and post_id the docid of the post in it.
+    __tablename__ = "pending_captions"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    blog: Mapped[str]
+    post_id: Mapped[int]
+    caption: Mapped[str]
+
+    def __repr__(self):
+        return f"PendingCaption({self.blog}, {self.post_id})"
@@ -1,6 +1,6 @@
 from typing import List, Optional
-from sqlalchemy import ForeignKey, UniqueConstraint, Column
-from sqlalchemy.orm import Mapped, relationship
+from sqlalchemy import ForeignKey, Index, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from enum import StrEnum, auto
 
@@ -17,31 +17,43 @@ class ImageState(StrEnum):
 class Image(Base):
     __tablename__ = "images"
 
-    id: Mapped[int] = Column(primary_key=True)
-    media_key: Mapped[str] = Column(unique=True)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    media_key: Mapped[str] = mapped_column(unique=True)
     url: Mapped[str]
     state: Mapped[ImageState]
     created: Mapped[int]
     assigned: Mapped[Optional[int]]
     agent: Mapped[Optional[str]]
+    # identifies the batch an image was assigned in, see clip_offer
+    lease: Mapped[Optional[str]] = mapped_column(index=True)
+    # perceptual hash of the image, and its bands, see phash.py
+    phash: Mapped[Optional[int]]
+    phash0: Mapped[Optional[int]] = mapped_column(index=True)
+    phash1: Mapped[Optional[int]] = mapped_column(index=True)
+    phash2: Mapped[Optional[int]] = mapped_column(index=True)
+    phash3: Mapped[Optional[int]] = mapped_column(index=True)
     captioned: Mapped[Optional[int]]
     caption: Mapped[Optional[str]]
     error: Mapped[Optional[str]]
 
     posts: Mapped[List["ImageInPost"]] = relationship("ImageInPost", back_populates="image")
 
+    # for clip_offer, which takes the oldest available images
+    __table_args__ = (Index("ix_images_state_created", "state", "created"),)
+
 
 class ImageInPost(Base):
     __tablename__ = "images_in_posts"
 
-    id: Mapped[int] = Column(primary_key=True)
-    image_id: Mapped[int] = Column(ForeignKey("images.id"))
+    id: Mapped[int] = mapped_column(primary_key=True)
+    image_id: Mapped[int] = mapped_column(ForeignKey("images.id"))
     image: Mapped["Image"] = relationship("Image", back_populates="posts")
-    post_id: Mapped[int] = Column()
-    blog: Mapped[str] = Column()
+    post_id: Mapped[int]
+    blog: Mapped[str]
 
     __table_args__ = (
         UniqueConstraint("image_id", "post_id", "blog", name="_uniqueness"),
+        Index("ix_images_in_posts_blog_post_id", "blog", "post_id"),
     )
 
     def __repr__(self):
@@ -0,0 +1,15 @@
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class OEmbed(Base):
+    # Cached responses from Tumblr's oEmbed endpoint, for the embed renderer.
+    __tablename__ = "oembeds"
+
+    url: Mapped[str] = mapped_column(primary_key=True)
+    html: Mapped[str]
+    fetched: Mapped[int]
+
+    def __repr__(self):
+        return f"OEmbed({self.url}, {self.fetched})"
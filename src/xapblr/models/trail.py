@@ -0,0 +1,16 @@
+from sqlalchemy.orm import Mapped, mapped_column
+
+from .base import Base
+
+
+class Trail(Base):
+    # Trail entries are shared between all reblogs of a post, so they are
+    # stored once, keyed by a hash of their content, and referenced from the
+    # document data of each post.
+    __tablename__ = "trails"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    data: Mapped[bytes]
+
+    def __repr__(self):
+        return f"Trail({self.key})"
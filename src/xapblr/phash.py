@@ -0,0 +1,36 @@
+from PIL import Image
+
+# Perceptual hashes identify the same picture uploaded several times, possibly
+# rescaled or recompressed, so that it is only captioned once. Hashes are 64
+# bits; they are compared by the number of differing bits.
+
+# The most hashes looked up in one request to the server's /clip/similar;
+# agents split larger lookups.
+MAX_LOOKUP = 256
+
+
+def dhash(im):
+    # Difference hash: whether each pixel of a 9x8 grayscale thumbnail is
+    # brighter than its right neighbour.
+    px = im.convert("L").resize((9, 8), Image.Resampling.BOX).tobytes()
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return h
+
+
+def distance(a, b):
+    return ((a ^ b) & (2**64 - 1)).bit_count()
+
+
+def bands(h):
+    # Splits a hash into four 16 bit bands. Hashes differing in at most 3 bits
+    # have at least one band in common, so near-duplicates can be looked up by
+    # band.
+    return [(h >> (16 * i)) & 0xFFFF for i in range(4)]
+
+
+def to_signed(h):
+    # SQLite integers are signed
+    return h - 2**64 if h >= 2**63 else h
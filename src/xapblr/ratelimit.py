@@ -0,0 +1,119 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from fcntl import flock, LOCK_EX, LOCK_UN
+from json import dump, load, JSONDecodeError
+from time import sleep, time
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from .config import config
+from .utils import get_db_dir
+
+try:
+    # Tumblr's daily limit resets at midnight EST
+    tumblr_tz = ZoneInfo("America/New_York")
+except ZoneInfoNotFoundError:
+    tumblr_tz = timezone(timedelta(hours=-5))
+
+
+class RateLimiter:
+    """
+    Token buckets for the Tumblr API rate limits (hourly and per calendar day),
+    persisted in the data directory so that they are shared by all concurrently
+    running xapblr processes.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        cfg = config["ratelimit"]
+        self.hourly = cfg["hourly"]
+        self.daily = cfg["daily"]
+        self.burst = cfg["burst"]
+        self.backoff = cfg["backoff"]
+        self.path = get_db_dir() / "ratelimit.json"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock_path = get_db_dir() / "ratelimit.lock"
+
+    @contextmanager
+    def state(self):
+        # The lock is held on a separate file, so that the state file can be
+        # truncated and rewritten while locked.
+        with self.lock_path.open("a") as lock:
+            flock(lock, LOCK_EX)
+            try:
+                try:
+                    with self.path.open() as f:
+                        state = load(f)
+                except (IOError, JSONDecodeError):
+                    state = {}
+                yield state
+                with self.path.open("w") as f:
+                    dump(state, f)
+            finally:
+                flock(lock, LOCK_UN)
+
+    def take(self, state):
+        # Try to take a token from both buckets. Returns the number of seconds
+        # to wait before trying again, or 0 on success.
+        now = time()
+        blocked_until = state.get("blocked_until", 0)
+        if now < blocked_until:
+            return blocked_until - now
+
+        tokens = state.get("tokens", self.burst)
+        tokens += (now - state.get("updated", now)) * self.hourly / 3600
+        state["tokens"] = tokens = min(tokens, self.burst)
+        state["updated"] = now
+
+        today = datetime.now(tumblr_tz).date()
+        if state.get("day", None) != today.isoformat():
+            state["day"] = today.isoformat()
+            state["used_today"] = 0
+        if state["used_today"] >= self.daily:
+            tomorrow = datetime.combine(
+                today + timedelta(days=1), datetime.min.time(), tumblr_tz
+            )
+            return tomorrow.timestamp() - now
+
+        if tokens < 1:
+            return (1 - tokens) * 3600 / self.hourly
+        state["tokens"] -= 1
+        state["used_today"] += 1
+        return 0
+
+    def acquire(self):
+        if not self.enabled:
+            return
+        while True:
+            with self.state() as state:
+                wait = self.take(state)
+            if wait == 0:
+                return
+            sleep(wait)
+
+    def block(self, attempt):
+        # Back off exponentially after being rate-limited by Tumblr. The block
+        # is shared, since other processes are using the same budget.
+        wait = min(self.backoff * 2**attempt, 3600)
+        if self.enabled:
+            with self.state() as state:
+                state["tokens"] = 0
+                state["blocked_until"] = max(
+                    state.get("blocked_until", 0), time() + wait
+                )
+        else:
+            sleep(wait)
+
+    def call(self, f, *args, **kwargs):
+        # Call the pytumblr method f, retrying after a backoff on HTTP 429.
+        attempt = 0
+        while True:
+            self.acquire()
+            response = f(*args, **kwargs)
+            try:
+                status = response["meta"]["status"]
+            except (KeyError, TypeError):
+                return response
+            if status != 429:
+                return response
+            self.block(attempt)
+            attempt += 1
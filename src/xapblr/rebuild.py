@@ -1,34 +1,140 @@
-from json import loads
-from xapian import Enquire, Query, TermGenerator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from shutil import rmtree
+from xapian import (
+    DB_CREATE_OR_OPEN,
+    DB_OPEN,
+    DBCOMPACT_NO_RENUMBER,
+    Database,
+    TermGenerator,
+    WritableDatabase,
+)
+from .captions import apply_captions
+from .compact import reset_commits
+from .config import config
+from .db import db as sqldb
 from .index import index_post, append_images, queue_images
-from .utils import get_db
+from .shards import get_shards
+from .storage import load_posts, store_trails
+from .utils import LRUCache, get_db, get_db_path, swap_db
 
 
 def rebuild(args):
-    db = get_db(args.blog, "w")
+    # Shards of a sharded blog are rebuilt one after the other.
+    for (name, _) in get_shards(args.blog):
+        rebuild_db(name, args.jobs)
+
+
+def rebuild_db(name, jobs):
+    # Holding the database open for writing locks out any concurrent index,
+    # whose changes would otherwise be lost when the rebuilt database is
+    # swapped in. Readers keep using the old database until then.
+    db = get_db(name, "w")
     count = db.get_doccount()
     if count == 0:
         return
 
-    tg = TermGenerator()
-    enq = Enquire(db)
-    enq.set_query(Query.MatchAll)
-    enq.set_sort_by_value_then_relevance(0, True)
-    offset = 0
-    perpage = 1000
-    print(f"Rebuilding {count} posts (. = {perpage} posts)")
-    while True:
-        matches = enq.get_mset(offset, perpage)
-        images = {}
-        if matches.empty():
-            break
-        for m in matches:
-            old = m.document
-            (id_term, post_doc, out_data) = index_post(loads(old.get_data()), tg)
-            did = db.replace_document(id_term, post_doc)
-            append_images(images, out_data, did)
-        queue_images(db, images, args.blog)
-        offset += perpage
-        print(".", end="", flush=True)
+    path = get_db_path(name)
+    shadow = path.with_name(f".{path.name}.rebuild")
+    rmtree(shadow, ignore_errors=True)
+    shadow.mkdir(parents=True)
+
+    # Split the documents into ranges of docids, each rebuilt into its own
+    # part by a worker process. Docids are preserved, since images_in_posts
+    # refers to them, and the ranges are disjoint so that the parts can be
+    # merged without renumbering.
+    chunk = config["rebuild"]["chunk"]
+    last = db.get_lastdocid()
+    ranges = [(lo, min(lo + chunk - 1, last)) for lo in range(1, last + 1, chunk)]
+    print(f"Rebuilding {count} posts in {name} (. = {chunk} posts)")
+
+    parts = []
+    images = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as pool:
+        futures = [
+            pool.submit(rebuild_range, str(path), str(shadow / f"part{lo}"), lo, hi)
+            for (lo, hi) in ranges
+        ]
+        for f in as_completed(futures):
+            (lo, part, n, part_images, trails) = f.result()
+            store_trails(trails)
+            for k, v in part_images.items():
+                if k in images.keys():
+                    images[k]["posts"] += v["posts"]
+                else:
+                    images[k] = v
+            if n > 0:
+                parts.append((lo, part))
+            print(".", end="", flush=True)
     print()
+
+    print("Merging... ", end="", flush=True)
+    merged = Database()
+    for _, part in sorted(parts):
+        merged.add_database(Database(part))
+    new_path = shadow / "db"
+    merged.compact(str(new_path), DBCOMPACT_NO_RENUMBER)
+    merged.close()
+
+    new = WritableDatabase(str(new_path), DB_OPEN)
+    for k in db.metadata_keys():
+        new.set_metadata(k, db.get_metadata(k))
+    # the rebuilt database is compacted
+    reset_commits(new)
+    queue_images(images, name)
+    new.commit()
+    # captions are not part of the post data, so they are added back
+    apply_captions({name: new})
+    new.close()
+
+    swap_db(path, new_path)
+    db.close()
+    rmtree(shadow)
     print("Done.")
+
+
+worker_trail_cache = None
+
+
+def init_worker():
+    global worker_trail_cache
+    # SQLite connections inherited from the parent must not be reused.
+    sqldb.engine.dispose(close=False)
+    worker_trail_cache = LRUCache(config["index"]["trail_cache"])
+
+
+def iter_docids(db, lo, hi):
+    postlist = db.postlist("")
+    try:
+        item = postlist.skip_to(lo)
+        while item.docid <= hi:
+            yield item.docid
+            item = next(postlist)
+    except StopIteration:
+        return
+
+
+def rebuild_range(path, part, lo, hi):
+    # Rebuild the documents with docids between lo and hi into the database
+    # part. Returns the images and trail entries seen, for the parent process
+    # to record.
+    src = Database(path)
+    dst = WritableDatabase(part, DB_CREATE_OR_OPEN)
+    tg = TermGenerator()
+    images = {}
+    trails = {}
+
+    docids = list(iter_docids(src, lo, hi))
+    batch = 500
+    for i in range(0, len(docids), batch):
+        dids = docids[i : i + batch]
+        posts = load_posts([src.get_document(did).get_data() for did in dids])
+        for did, post in zip(dids, posts):
+            (_, post_doc, out_data) = index_post(post, tg, worker_trail_cache)
+            dst.replace_document(did, post_doc)
+            append_images(images, out_data, did)
+            trails.update(out_data["trails"])
+
+    dst.commit()
+    dst.close()
+    src.close()
+    return (lo, part, len(docids), images, trails)
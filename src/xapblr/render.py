@@ -1,14 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
 from json import dumps
-from requests import get
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from sqlalchemy import select
 from textwrap import wrap
+from time import time
 
-from .utils import get_author, format_timestamp
+from .config import config
+from .db import db as sqldb
+from .models.oembed import OEmbed
+from .utils import LRUCache, get_author, format_timestamp
+
+rendered_cache = LRUCache(config["render"]["cache_size"])
+
+
+def cached(f):
+    # Cache the output of a renderer by the post's digest, so that each
+    # revision of a post is rendered only once. Posts that do not come from
+    # the database have no digest and are always rendered.
+    @wraps(f)
+    def cached_f(post, args):
+        digest = getattr(post, "digest", None)
+        if digest is None:
+            return f(post, args)
+        key = (digest, f.__name__, getattr(args, "width", None))
+        try:
+            return rendered_cache[key]
+        except KeyError:
+            out = rendered_cache[key] = f(post, args)
+            return out
+
+    return cached_f
 
 
 def render_json(post, args):
     return dumps(post)
 
 
+@cached
 def render_plain(post, args):
     width = args.width or 80
     rendered = [render_plain_one(p, width) for p in post["trail"]]
@@ -40,6 +71,7 @@ def render_plain_one(post, width):
     return out
 
 
+@cached
 def render_md(post, args):
     width = args.width or 540
     rendered = [render_md_one(p, width) for p in post["trail"]]
@@ -88,12 +120,17 @@ def render_md_block(block, pref_width):
     return ""
 
 
-def render_html(post, args):
+@cached
+def render_html_body(post, args):
     rendered = [render_html_one(p) for p in post["trail"]]
     rendered.append(render_html_one(post))
     delim = "\n<hr />\n"
     inner_html = delim.join([r for r in rendered if r])
+    return inner_html.replace("\n", "\n\t")[:-1]
+
 
+def render_html(post, args):
+    # the timestamp is relative to now, so only the body can be cached
     from datetime import datetime
 
     ts = post["timestamp"]
@@ -104,7 +141,7 @@ def render_html(post, args):
     return (
         "<div class='tumblr-post'>\n\t"
         f'<time datetime="{ts_iso}" title="{ts_words}">{ts_hf}</time>'
-        + inner_html.replace("\n", "\n\t")[:-1]
+        + render_html_body(post, args)
         + "\n</div>\n"
     )
 
@@ -152,12 +189,63 @@ def render_html_block(block):
     return ""
 
 
-def render_embed(post, args):
-    url = "https://www.tumblr.com/oembed/1.0"
-    response = get(url, {"url": post["post_url"]})
+oembed_session = Session()
+oembed_session.mount("https://", HTTPAdapter(pool_maxsize=config["oembed"]["workers"]))
+oembed_session.mount("http://", HTTPAdapter(pool_maxsize=config["oembed"]["workers"]))
+
+
+def fetch_embed(url):
+    response = oembed_session.get(
+        config["oembed"]["endpoint"],
+        params={"url": url},
+        timeout=config["oembed"]["timeout"],
+    )
     return response.json()["html"]
 
 
+def store_embeds(s, embeds):
+    now = int(time())
+    for url, html in embeds.items():
+        s.merge(OEmbed(url=url, html=html, fetched=now))
+    s.commit()
+
+
+def prefetch_embeds(posts):
+    # Fetch the embeds for posts not yet in the cache concurrently, instead of
+    # one by one as they are rendered.
+    urls = {p["post_url"] for p in posts}
+    expired = int(time()) - config["oembed"]["ttl"]
+    with sqldb.session() as s:
+        q = select(OEmbed.url).where(OEmbed.url.in_(urls) & (OEmbed.fetched > expired))
+        missing = list(urls - set(s.scalars(q)))
+        if len(missing) == 0:
+            return
+
+        def try_fetch(url):
+            # failures are retried, and reported, by render_embed
+            try:
+                return fetch_embed(url)
+            except (RequestException, ValueError, KeyError):
+                return None
+
+        with ThreadPoolExecutor(config["oembed"]["workers"]) as pool:
+            htmls = pool.map(try_fetch, missing)
+        embeds = {url: html for url, html in zip(missing, htmls) if html is not None}
+        store_embeds(s, embeds)
+
+
+def render_embed(post, args):
+    url = post["post_url"]
+    expired = int(time()) - config["oembed"]["ttl"]
+    with sqldb.session() as s:
+        embed = s.get(OEmbed, url)
+        if embed is not None and embed.fetched > expired:
+            return embed.html
+        html = fetch_embed(url)
+        store_embeds(s, {url: html})
+    return html
+
+
 renderers = {
     "json": render_json,
     "html": render_html,
@@ -165,3 +253,13 @@ renderers = {
     "plain": render_plain,
     "md": render_md,
 }
+
+prefetchers = {
+    "embed": prefetch_embeds,
+}
+
+
+def prefetch(renderer, posts):
+    # Let the renderer fetch what it needs for all posts at once.
+    if renderer in prefetchers.keys():
+        prefetchers[renderer](posts)
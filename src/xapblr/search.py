@@ -1,7 +1,10 @@
 from datetime import datetime
-from json import loads
+from sys import stderr
+from threading import local
 from xapian import (
     Database,
+    DatabaseError,
+    DatabaseModifiedError,
     Enquire,
     FieldProcessor,
     Query,
@@ -12,21 +15,39 @@ from xapian import (
     sortable_unserialise,
 )
 
+from .config import config
 from .date_parser import parse_date
-from .render import renderers
-from .utils import get_db, encode_tag, prefixes, value_slots
+from .render import prefetch, renderers
+from .shards import get_shards, overlaps
+from .storage import load_posts
+from .utils import (
+    LRUCache,
+    get_db,
+    encode_tag,
+    list_blog_names,
+    prefixes,
+    value_slots,
+)
 
 
 def search_command(args):
-    res = search(args)
+    if args.all:
+        res = search_all(args)
+    else:
+        res = search(args)
     try:
         print("An error occured: " + res[0]["error"])
         return
     except KeyError:
         pass
-    for m in res[1]:
-        out = renderers[args.renderer](m, args)
-        print(out)
+    chunks = res[1] if args.all else [list(res[1])]
+    for posts in chunks:
+        prefetch(args.renderer, posts)
+        for m in posts:
+            out = renderers[args.renderer](m, args)
+            print(out)
+    if res[0].get("cursor", None) is not None:
+        print(f"Next cursor: {res[0]['cursor']}", file=stderr)
 
 
 class ImageProcessor(FieldProcessor):
@@ -42,6 +63,8 @@ class DateRangeProcessor(RangeProcessor):
     def __init__(self, slot, prefix):
         super(DateRangeProcessor, self).__init__(slot, prefix)
         self.slot = slot
+        # the (begin, end) timestamps of the ranges in the last parsed query
+        self.ranges = []
 
     def __call__(self, begin, end):
         begin, end = begin.decode("utf8"), end.decode("utf8")
@@ -54,9 +77,10 @@ class DateRangeProcessor(RangeProcessor):
                 end = datetime.now().timestamp()
             else:
                 end = parse_date(end)
-            begin, end = sortable_serialise(begin), sortable_serialise(end)
         except ValueError as e:
             raise QueryParserError(str(e))
+        self.ranges.append((begin, end))
+        begin, end = sortable_serialise(begin), sortable_serialise(end)
         return Query(Query.OP_VALUE_RANGE, self.slot, begin, end)
 
 
@@ -73,51 +97,234 @@ def search(args):
         "pagesize": pagesize,
     }
 
-    db = get_db(args.blog, "r")
-    qp = QueryParser()
-    qp.set_stemming_strategy(QueryParser.STEM_NONE)
-    qp.set_default_op(Query.OP_AND)
+    try:
+        (query, span) = parse_query(args.search)
+        cursor = getattr(args, "cursor", None)
+        if cursor is not None and args.sort != "relevance":
+            (query, offset) = apply_cursor(query, args.sort, cursor)
+        else:
+            cursor = None
+    except (QueryParserError, ValueError) as e:
+        meta["matches"] = 0
+        meta["error"] = str(e)
+        return (meta, iter([]))
 
-    qp.add_rangeprocessor(DateRangeProcessor(value_slots["timestamp"], "date:"))
+    (db, revision) = get_reader(args.blog, span)
+    # whether a cursor was asked for decides whether meta has one
+    key = (str(query), args.sort, offset, pagesize, cursor is not None, revision)
+    try:
+        (cached_meta, posts) = results_cache[key]
+        meta.update(cached_meta)
+    except KeyError:
+        posts = run_query(db, query, args.sort, offset, pagesize, cursor, meta)
+        results_cache[key] = (dict(meta), posts)
+
+    # callers may modify the posts they get, but not the cached ones
+    return (meta, (p.copy() for p in posts))
 
-    [
-        qp.add_boolean_prefix(p, prefixes[p])
-        for p in ["author", "has", "link", "media", "op"]
-    ]
-    qp.add_prefix("image", prefixes["image"])
-    qp.add_boolean_prefix("tag", TagProcessor())
 
-    qstr = " ".join(args.search)
+def search_all(args):
+    """
+    Like search, but iter is an iterator over chunks (lists) of all matches
+    after args.offset, fetched as they are iterated over so that memory use
+    does not grow with the number of matches.
+    """
+    meta = {}
     try:
-        query = qp.parse_query(qstr)
+        (query, span) = parse_query(args.search)
     except QueryParserError as e:
         meta["matches"] = 0
         meta["error"] = str(e)
         return (meta, iter([]))
+    (db, _) = get_reader(args.blog, span)
+
+    def chunks():
+        chunk = config["search"]["chunk"]
+        offset = args.offset or 0
+        skip = 0
+        cursor = ""
+        if args.sort != "relevance":
+            # Date-sorted results are walked with a cursor (see search), so
+            # that each chunk is as cheap as the first. The offset is then
+            # skipped from the first chunks.
+            (skip, offset) = (offset, 0)
+        while True:
+            if args.sort == "relevance":
+                (q, cursor) = (query, None)
+            else:
+                (q, offset) = apply_cursor(query, args.sort, cursor)
+            page_meta = {}
+            posts = run_query(db, q, args.sort, offset, chunk, cursor, page_meta)
+            n = len(posts)
+            if skip > 0:
+                (posts, skip) = (posts[skip:], max(skip - n, 0))
+            if len(posts) > 0:
+                yield posts
+
+            # The number of matches is only estimated, so the walk ends with
+            # the first chunk that is not full.
+            if n < chunk:
+                return
+            if args.sort == "relevance":
+                offset += chunk
+            else:
+                cursor = page_meta["cursor"]
+                if cursor is None:
+                    return
+
+    return (meta, chunks())
+
+
+def parse_query(search):
+    # Returns the query, and the (begin, end) timestamps that all its matches
+    # lie between, or None if they are not restricted by date.
+    qp = get_parser()
+    cache.dates.ranges = []
+    query = qp.parse_query(" ".join(search))
+    ranges = cache.dates.ranges
+    # With several ranges, there is no telling which of them is required.
+    if len(ranges) == 1 and requires_range(query):
+        return (query, ranges[0])
+    return (query, None)
+
+
+def requires_range(query):
+    # Whether matches of query must match a date range in it.
+    t = query.get_type()
+    if t == Query.OP_VALUE_RANGE:
+        return True
+    subs = [query.get_subquery(i) for i in range(query.get_num_subqueries())]
+    if t in [Query.OP_AND, Query.OP_FILTER]:
+        return any(requires_range(q) for q in subs)
+    if t in [Query.OP_AND_NOT, Query.OP_AND_MAYBE, Query.OP_SCALE_WEIGHT]:
+        return requires_range(subs[0])
+    return False
+
 
+def apply_cursor(query, sort, cursor):
+    # Returns the query restricted to matches from the cursor on, and the
+    # offset to fetch them from.
+    (cursor_ts, skip) = parse_cursor(cursor)
+    if cursor_ts is not None:
+        # Resume after the last match seen, skipping the matches with the
+        # same timestamp that were already seen.
+        op = Query.OP_VALUE_LE if sort == "newest" else Query.OP_VALUE_GE
+        bound = Query(op, value_slots["timestamp"], sortable_serialise(cursor_ts))
+        query = Query(Query.OP_FILTER, query, bound)
+    return (query, skip)
+
+
+def run_query(db, query, sort, offset, pagesize, cursor, meta):
     enq = Enquire(db)
-    if args.sort == "newest":
+    if sort == "newest":
         enq.set_sort_by_value_then_relevance(0, True)
-    elif args.sort == "oldest":
+    elif sort == "oldest":
         enq.set_sort_by_value_then_relevance(0, False)
-    elif args.sort == "relevance":
+    elif sort == "relevance":
         pass
     enq.set_query(query)
-    matches = enq.get_mset(offset, pagesize)
+    try:
+        matches = enq.get_mset(offset, pagesize)
+    except DatabaseModifiedError:
+        db.reopen()
+        matches = enq.get_mset(offset, pagesize)
     meta["matches"] = matches.get_matches_estimated()
-    if matches.empty():
-        match_iter = iter([])
+    if cursor is not None:
+        meta["cursor"] = next_cursor(matches, offset, cursor)
+    return load_posts([m.document.get_data() for m in matches])
+
+
+# Databases and query parsers are kept between searches, one set per thread
+# since neither is thread-safe.
+cache = local()
+# Results are cached by query and database revision, so that they are
+# invalidated by any commit or when a database is replaced.
+results_cache = LRUCache(config["search"]["cache_size"])
+
+
+def get_blogs(spec):
+    # Searches can span several blogs, given as a comma-separated list, or *
+    # for all indexed blogs.
+    if spec == "*":
+        return tuple(list_blog_names())
+    return tuple(sorted({b.strip() for b in spec.split(",") if b.strip()}))
+
+
+def get_reader(spec, span=None):
+    # Returns a database combining the blogs in spec, and the revision of its
+    # contents. Shards of sharded blogs holding no posts in span, a (begin,
+    # end) pair of timestamps, are left out.
+    shards = [s for blog in get_blogs(spec) for s in get_shards(blog)]
+    subs = [get_handle(name) for (name, s) in shards if overlaps(s, span)]
+
+    if len(subs) == 1:
+        db = subs[0]
     else:
+        db = Database()
+        [db.add_database(sub) for sub in subs]
+    revision = tuple((sub.get_uuid(), sub.get_revision()) for sub in subs)
+    return (db, revision)
 
-        def match_iterf():
-            for match in matches:
-                doc = match.document
-                post_json = doc.get_data().decode("utf-8")
-                yield loads(post_json)
 
-        match_iter = match_iterf()
+def get_handle(name):
+    # One handle is kept per database, however many searches combine it.
+    if not hasattr(cache, "readers"):
+        cache.readers = LRUCache(config["search"]["readers"])
+    db = cache.readers.get(name, None)
+    if db is not None:
+        try:
+            # cheap if nothing has been committed since the last search
+            db.reopen()
+        except DatabaseError:
+            # e.g. the database was replaced by a rebuild
+            db = None
+    if db is None:
+        db = cache.readers[name] = get_db(name, "r")
+    return db
+
+
+def get_parser():
+    if not hasattr(cache, "parser"):
+        qp = QueryParser()
+        qp.set_stemming_strategy(QueryParser.STEM_NONE)
+        qp.set_default_op(Query.OP_AND)
+
+        cache.dates = DateRangeProcessor(value_slots["timestamp"], "date:")
+        qp.add_rangeprocessor(cache.dates)
+
+        [
+            qp.add_boolean_prefix(p, prefixes[p])
+            for p in ["author", "has", "link", "media", "op"]
+        ]
+        qp.add_prefix("image", prefixes["image"])
+        qp.add_boolean_prefix("tag", TagProcessor())
+        cache.parser = qp
+    return cache.parser
 
-    return (meta, match_iter)
+
+def parse_cursor(cursor):
+    # A cursor is "T:N": resume at timestamp T, skipping N matches with that
+    # timestamp. The empty cursor starts at the beginning.
+    if cursor == "":
+        return (None, 0)
+    try:
+        (ts, skip) = cursor.split(":")
+        return (int(ts), int(skip))
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def next_cursor(matches, offset, cursor):
+    # Returns the cursor for the page after matches, or None if it is the last.
+    if matches.empty() or matches.get_matches_lower_bound() <= offset + matches.size():
+        return None
+    (cursor_ts, _) = parse_cursor(cursor)
+    tss = [int(sortable_unserialise(m.document.get_value(0))) for m in matches]
+    last = tss[-1]
+    skip = len(tss) - next(i for i, ts in enumerate(tss) if ts == last)
+    if skip == len(tss) and last == cursor_ts:
+        skip += offset
+    return f"{last}:{skip}"
 
 
 def get_end(src, latest=True):
@@ -0,0 +1,129 @@
+from datetime import datetime, timezone
+from shutil import rmtree
+
+from .utils import get_db, get_db_path
+
+# A sharded blog is a directory holding one database per year, named after
+# the year, and a stub file listing them, which xapian opens as one database.
+# Index metadata (e.g. the checkpoint) is kept in a separate database, "meta",
+# which holds no posts. It is listed in the stub too, since xapian refuses to
+# open a stub listing no databases.
+STUB = "XAPIANDB"
+META = "meta"
+
+
+def is_sharded(blog):
+    return (get_db_path(blog) / STUB).exists()
+
+
+def init_sharded(blog):
+    path = get_db_path(blog)
+    if path.exists():
+        # an empty, unsharded database
+        rmtree(path)
+    path.mkdir(parents=True)
+    get_db(f"{blog}/{META}", "w").close()
+    write_stub(blog)
+
+
+def list_shards(blog):
+    path = get_db_path(blog)
+    return sorted(c.name for c in path.iterdir() if c.is_dir() and c.name.isdigit())
+
+
+def write_stub(blog):
+    path = get_db_path(blog)
+    tmp = path / f".{STUB}.tmp"
+    with tmp.open("w") as f:
+        f.write(f"auto {META}\n")
+        for shard in list_shards(blog):
+            f.write(f"auto {shard}\n")
+    tmp.rename(path / STUB)
+
+
+def shard_year(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).year
+
+
+def shard_span(year):
+    # The range of timestamps of posts in the shard for year.
+    begin = datetime(int(year), 1, 1, tzinfo=timezone.utc)
+    end = datetime(int(year) + 1, 1, 1, tzinfo=timezone.utc)
+    return (begin.timestamp(), end.timestamp())
+
+
+def get_shards(blog):
+    # Returns (name, span) for each database of blog: the name to pass to
+    # get_db, and the range of timestamps of its posts, or None if unbounded.
+    if not is_sharded(blog):
+        return [(blog, None)]
+    return [(f"{blog}/{y}", shard_span(y)) for y in list_shards(blog)]
+
+
+def overlaps(span, other):
+    # span is half-open, other is closed; either may be None (unbounded).
+    if span is None or other is None:
+        return True
+    return other[0] < span[1] and other[1] >= span[0]
+
+
+class BlogWriter:
+    """
+    Writable access to the databases of a blog, sharded or not.
+    shard(timestamp) returns the name and database for a post: the blog itself,
+    or the shard for the year of the post. The name can be passed to get_db.
+    commit() only commits if a post was written or metadata changed.
+    """
+
+    def __init__(self, blog):
+        self.blog = blog
+        self.sharded = is_sharded(blog)
+        self.dbs = {}
+        # names of the databases posts were written to since the last commit
+        self.written = set()
+        self.dirty = False
+        if self.sharded:
+            self.meta = get_db(f"{blog}/{META}", "w")
+        else:
+            self.meta = self.dbs[blog] = get_db(blog, "w")
+
+    def shard(self, timestamp):
+        if not self.sharded:
+            self.written.add(self.blog)
+            return (self.blog, self.meta)
+        name = f"{self.blog}/{shard_year(timestamp)}"
+        if name not in self.dbs.keys():
+            new = not get_db_path(name).exists()
+            self.dbs[name] = get_db(name, "w")
+            if new:
+                write_stub(self.blog)
+        self.written.add(name)
+        return (name, self.dbs[name])
+
+    def get(self, name):
+        return self.dbs[name]
+
+    def get_metadata(self, key):
+        return self.meta.get_metadata(key)
+
+    def set_metadata(self, key, value):
+        if self.meta.get_metadata(key) == value.encode("utf-8"):
+            return
+        self.meta.set_metadata(key, value)
+        self.dirty = True
+
+    def commit(self):
+        if not self.written and not self.dirty:
+            return
+        # Metadata is committed last, so that it never runs ahead of the
+        # documents it describes.
+        for name in self.written:
+            db = self.dbs[name]
+            # counted to compact the database after index.compact_every commits
+            commits = int(db.get_metadata("commits") or 0)
+            db.set_metadata("commits", str(commits + 1))
+            if db is not self.meta:
+                db.commit()
+        self.meta.commit()
+        self.written = set()
+        self.dirty = False
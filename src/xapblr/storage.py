@@ -0,0 +1,137 @@
+from hashlib import sha1
+from json import dumps, loads
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sys import stderr
+from zlib import compressobj, decompressobj
+
+from .db import db as sqldb
+from .models.trail import Trail
+
+# Document data is versioned by its first byte. Databases written before
+# versioning hold the bare JSON of the post, which always starts with "{".
+FORMAT_JSON = b"{"
+FORMAT_ZLIB = b"\x01"
+
+# Preset dictionary for FORMAT_ZLIB: strings common to NPF posts, so that even
+# short posts compress well. zlib favours matches near the end of the
+# dictionary, so the most frequent strings come last.
+# NEVER change this: existing documents cannot be decoded without it. If a
+# better dictionary is needed, add a new format.
+npf_dictionary = "".join(
+    [
+        '"interactability_reblog":"everyone","interactability_blaze":"everyone",',
+        '"can_edit":false,"can_delete":false,"can_like":true,"can_reblog":true,',
+        '"can_send_in_message":true,"can_reply":true,"display_avatar":true,',
+        '"is_blocks_post_format":true,"should_open_in_legacy":false,',
+        '"is_paywalled":false,"is_commercial":false,"followed":false,',
+        '"liked":false,"state":"published","object_type":"post",',
+        '"original_type":"text","original_type":"photo","type":"blocks",',
+        '"recommended_source":null,"recommended_color":null,',
+        '"reblog_key":"","short_url":"https://tmblr.co/","slug":"","summary":"",',
+        '"date":"","note_count":0,"tags":[],"blog_name":"","id_string":"',
+        '"post_url":"https://www.tumblr.com/","parent_post_url":"',
+        '"tumblrmart_accessories":{},"can_show_badges":true,',
+        '"title":"","description":"","url":"https://","updated":',
+        '"broken_blog_name":"","uuid":"t:","name":"","blog":{"name":"',
+        '"poll_settings":{"multiple_choice":false,"close_status":"closed",',
+        '"expire_after":604800},"client_id":"","created_at":"","answers":[',
+        '{"answer_text":"","client_id":""}],"question":"","type":"poll",',
+        '"display_url":"","poster":[{"url":"","type":"image/jpeg",',
+        '"type":"link","type":"video","type":"audio","provider":"tumblr",',
+        '"layout":[{"type":"rows","display":[{"blocks":[0]},{"blocks":[1]}]}],',
+        '"type":"ask","attribution":{"type":"post","url":"","post":{"id":"',
+        '"subtype":"heading1","subtype":"heading2","subtype":"quote",',
+        '"subtype":"indented","subtype":"chat","subtype":"ordered-list-item",',
+        '"subtype":"unordered-list-item","type":"link","type":"mention",',
+        '"formatting":[{"start":0,"end":0,"type":"bold"},{"type":"italic",',
+        '"type":"strikethrough","type":"small","type":"color","hex":"#',
+        '"alt_text":"","caption":"","colors":{"c0":"","c1":""},',
+        '"type":"image/gif","type":"image/png","type":"image/webp",',
+        '"has_original_dimensions":true,"cropped":false,"media_key":"',
+        '"mediaKey":"","type":"image/jpeg","width":1280,"height":',
+        '{"type":"image","media":[{"url":"https://64.media.tumblr.com/',
+        '"post":{"id":"","timestamp":,"is_commercial":false},',
+        '"trail":[{"content":[],"layout":[],"blog":{"name":"',
+        '"timestamp":,"id":,"content":[{"type":"text","text":"',
+    ]
+).encode("utf-8")
+
+
+class Post(dict):
+    # A post loaded from the database. digest identifies the stored revision of
+    # the post, so that derived data (e.g. its rendering) can be cached.
+    digest = None
+
+    def copy(self):
+        p = Post(self)
+        p.digest = self.digest
+        return p
+
+
+def encode_post(post):
+    c = compressobj(9, zdict=npf_dictionary)
+    data = dumps(post, separators=(",", ":")).encode("utf-8")
+    return FORMAT_ZLIB + c.compress(data) + c.flush()
+
+
+def decode_post(data):
+    fmt = data[:1]
+    if fmt == FORMAT_JSON:
+        return loads(data)
+    elif fmt == FORMAT_ZLIB:
+        d = decompressobj(zdict=npf_dictionary)
+        return loads(d.decompress(data[1:]) + d.flush())
+    raise ValueError(f"Unknown document data format {fmt!r}")
+
+
+def trail_key(trail):
+    data = dumps(trail, sort_keys=True, separators=(",", ":"))
+    return sha1(data.encode("utf-8")).hexdigest()
+
+
+def store_trails(trails):
+    # Must be called before the documents referencing trails are committed.
+    rows = [{"key": k, "data": encode_post(t)} for k, t in trails.items()]
+    if len(rows) == 0:
+        return
+    with sqldb.session() as s:
+        chunk = 500
+        for i in range(0, len(rows), chunk):
+            stmt = insert(Trail).values(rows[i : i + chunk]).on_conflict_do_nothing()
+            s.execute(stmt)
+        s.commit()
+
+
+def load_posts(datas):
+    # Decode document data into posts, resolving trail references. Trail
+    # entries are stored as their key in the post's trail.
+    posts = []
+    for d in datas:
+        p = Post(decode_post(d))
+        # trail entries are referenced by their hash, so this covers them too
+        p.digest = sha1(d).hexdigest()
+        posts.append(p)
+    keys = {t for p in posts for t in p["trail"] if type(t) is str}
+    if len(keys) == 0:
+        return posts
+
+    trails = {}
+    with sqldb.session() as s:
+        chunk = 500
+        ks = list(keys)
+        for i in range(0, len(ks), chunk):
+            q = select(Trail).where(Trail.key.in_(ks[i : i + chunk]))
+            for t in s.scalars(q):
+                trails[t.key] = decode_post(t.data)
+    missing = keys - trails.keys()
+    if len(missing) > 0:
+        # e.g. left behind by an older version interrupted while indexing
+        print(f"Missing {len(missing)} trail entries, skipping them.", file=stderr)
+    for p in posts:
+        p["trail"] = [
+            trails[t] if type(t) is str else t
+            for t in p["trail"]
+            if type(t) is not str or t in trails
+        ]
+    return posts
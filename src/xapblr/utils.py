@@ -1,7 +1,11 @@
+from collections import OrderedDict
+from ctypes import CDLL, get_errno
 from datetime import datetime
 from pathlib import Path
-from os import environ
+from os import environ, fsencode, strerror
 from re import sub
+from shutil import rmtree
+from threading import Lock
 from urllib.parse import quote as urlencode
 
 from xapian import Database, WritableDatabase, DatabaseNotFoundError, DB_CREATE_OR_OPEN
@@ -43,10 +47,23 @@ def get_db_dir():
     return get_xdg_data_home() / "xapblr"
 
 
+def list_blog_names():
+    # hidden directories hold databases being rebuilt
+    return sorted(
+        child.name
+        for child in get_db_dir().iterdir()
+        if child.is_dir() and not child.name.startswith(".")
+    )
+
+
+def get_db_path(blog):
+    return get_db_dir() / blog
+
+
 def get_db(blog, mode="r"):
     # returns a xapian database object for the specified blog
     # mode = 'r' for reading, 'w' for writing
-    db_path = get_db_dir() / blog
+    db_path = get_db_path(blog)
     db_path.mkdir(parents=True, exist_ok=True)
     db_path_str = str(db_path)
     if mode == "w":
@@ -62,6 +79,35 @@ def get_db(blog, mode="r"):
             return Database(db_path_str, DB_CREATE_OR_OPEN)
 
 
+def swap_db(path, new_path):
+    # Replace the database at path with the one at new_path, deleting the old
+    # one. The swap is atomic: path never goes missing, since get_db would
+    # create an empty database there. Readers that already have the old
+    # database open can keep reading it.
+    exchange_paths(path, new_path)
+    rmtree(new_path)
+
+
+libc = CDLL(None, use_errno=True)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2  # renameat2, Linux
+RENAME_SWAP = 2  # renamex_np, macOS
+
+
+def exchange_paths(a, b):
+    # Atomically swap what the paths a and b point to.
+    a, b = fsencode(a), fsencode(b)
+    if hasattr(libc, "renameat2"):
+        ret = libc.renameat2(AT_FDCWD, a, AT_FDCWD, b, RENAME_EXCHANGE)
+    elif hasattr(libc, "renamex_np"):
+        ret = libc.renamex_np(a, b, RENAME_SWAP)
+    else:
+        raise OSError("Atomically exchanging paths is not supported on this system")
+    if ret != 0:
+        e = get_errno()
+        raise OSError(e, strerror(e), a.decode(), None, b.decode())
+
+
 def get_unique_term(doc):
     for t in doc.termlist():
         if t.term[0] == ord("Q"):
@@ -82,6 +128,41 @@ def encode_tag(tag):
     return (prefixes["tag"] + urlencode(tag.lower()))[:245]
 
 
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = Lock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
 def fix_date_range(d):
     def _fix(m):
         return m[0].replace(" ", "_")
@@ -1,19 +1,19 @@
-from sqlalchemy import func, select, update
+from sqlalchemy import func, or_, select, update
 from sqlalchemy.orm import joinedload
 
+from xapblr.captions import pending_captions
 from xapblr.config import config
-from xapblr.index import add_caption_to_doc
 from xapblr.models.image import Image, ImageState
 from xapblr.db import db
-from xapblr.utils import get_db
+from xapblr.phash import bands, distance, to_signed
 
 from time import time
-from xapian import TermGenerator
+from uuid import uuid4
 
 
 def clip_accept(imgs):
-    dbs = {}
-    tg = TermGenerator()
+    # Captions are queued with the images' new state, and added to the posts
+    # by captions.apply_captions.
     with db.session() as s:
         q = (
             select(Image)
@@ -31,50 +31,113 @@ def clip_accept(imgs):
                 img.state = ImageState.ERROR
                 img.error = submitted["error"]
             img.captioned = int(time())
+            img.lease = None
+            if submitted.get("phash", None) is not None:
+                set_phash(img, submitted["phash"])
 
             for p in img.posts:
-                if p.blog not in dbs.keys():
-                    dbs[p.blog] = get_db(p.blog, "w")
-                x = dbs[p.blog]
-                add_caption_to_doc(x, p.post_id, tg, img.caption)
+                pending_captions(s, p.blog, [p.post_id], img.caption)
         s.commit()
 
 
-def clip_offer(args):
-    out = {}
+def set_phash(img, h):
+    img.phash = to_signed(h)
+    (img.phash0, img.phash1, img.phash2, img.phash3) = bands(h)
+
+
+def clip_similar(hs):
+    # Returns, for each perceptual hash in hs, the caption of a captioned image
+    # whose hash is within clip.phash_distance of it, or None, so that agents
+    # can reuse it for duplicates. Candidates share a band of their hash with
+    # one in hs, which finds all matches within a distance of 3.
+    band_cols = [Image.phash0, Image.phash1, Image.phash2, Image.phash3]
+    hs_bands = list(zip(*[bands(h) for h in hs]))
+    q = select(Image.phash, Image.caption).where(
+        (Image.state == ImageState.CAPTIONED)
+        & Image.caption.is_not(None)
+        & or_(*[c.in_(set(bs)) for c, bs in zip(band_cols, hs_bands)])
+    )
+    best = [None] * len(hs)
     with db.session() as s:
-        # If an image was assigned more than timeout seconds ago, and has not
-        # been captioned yet, it is assumed that the assignee will not complete
-        # the job. We should mark the image as available for other agents.
-        conn = s.connection()
-        refresh = (
-            update(Image)
-            .where(
-                (Image.state == ImageState.ASSIGNED)
-                & (Image.assigned + config["clip"]["timeout"] < int(time()))
-            )
-            .values(state=ImageState.AVAILABLE)
-        )
-        conn.execute(refresh)
+        for phash, caption in s.execute(q):
+            for i, h in enumerate(hs):
+                d = distance(phash, h)
+                if d > config["clip"]["phash_distance"]:
+                    continue
+                if best[i] is None or d < best[i][0]:
+                    best[i] = (d, caption)
+    return [None if b is None else b[1] for b in best]
 
-        q = (
-            select(Image)
-            .where(Image.state == ImageState.AVAILABLE)
-            .order_by(Image.created)
-            .limit(config["clip"]["batch_size"])
-        )
-        n = (
-            s.query(func.count(Image.id))
-            .where(Image.state == ImageState.AVAILABLE)
-            .scalar()
+
+def offerable(now):
+    # Images that can be offered to agents: available ones, and those assigned
+    # more than clip.timeout seconds ago and not captioned yet. Their assignee
+    # is assumed not to complete the job, unless it renewed its lease.
+    expired = (Image.state == ImageState.ASSIGNED) & (
+        Image.assigned + config["clip"]["timeout"] < now
+    )
+    return (Image.state == ImageState.AVAILABLE) | expired
+
+
+# Counting the available images on every poll is wasteful with many agents, so
+# the count is cached for clip.count_ttl seconds.
+available_count = {"n": 0, "counted": 0}
+
+
+def get_remaining_count(s, taken):
+    # The number of images left to offer after taking some in s.
+    now = time()
+    if taken < config["clip"]["batch_size"]:
+        # all the available images were taken, so the count is known
+        available_count["n"] = 0
+        available_count["counted"] = now
+    elif now - available_count["counted"] > config["clip"]["count_ttl"]:
+        available_count["n"] = (
+            s.query(func.count(Image.id)).where(offerable(int(now))).scalar()
         )
-        imgs = s.scalars(q)
-        out["available"] = n
-        out["images"] = []
-        for i in imgs:
-            i.state = ImageState.ASSIGNED
-            i.agent = args["agent"]
-            i.assigned = int(time())
-            out["images"].append({"id": i.id, "media_key": i.media_key, "url": i.url})
+        available_count["counted"] = now
+    else:
+        available_count["n"] = max(available_count["n"] - taken, 0)
+    return available_count["n"]
+
+
+def clip_offer(args):
+    # Images are leased in a single statement, so that concurrent agents are
+    # never offered the same images.
+    now = int(time())
+    lease = uuid4().hex
+    batch = (
+        select(Image.id)
+        .where(offerable(now))
+        .order_by(Image.created)
+        .limit(config["clip"]["batch_size"])
+    )
+    stmt = (
+        update(Image)
+        .where(Image.id.in_(batch))
+        .values(state=ImageState.ASSIGNED, agent=args["agent"], assigned=now, lease=lease)
+        .returning(Image.id, Image.media_key, Image.url)
+    )
+    out = {"lease": {"token": lease, "timeout": config["clip"]["timeout"]}}
+    with db.session() as s:
+        conn = s.connection()
+        rows = conn.execute(stmt).all()
+        out["images"] = [{"id": i, "media_key": k, "url": u} for (i, k, u) in rows]
+        # available includes the images offered
+        out["available"] = len(rows) + get_remaining_count(s, len(rows))
         s.commit()
     return out
+
+
+def clip_renew(lease):
+    # Renew the lease on the images of a batch that are not captioned yet.
+    # Returns the number of images still leased.
+    stmt = (
+        update(Image)
+        .where((Image.lease == lease) & (Image.state == ImageState.ASSIGNED))
+        .values(assigned=int(time()))
+    )
+    with db.session() as s:
+        n = s.connection().execute(stmt).rowcount
+        s.commit()
+    return n
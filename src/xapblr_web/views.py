@@ -2,14 +2,17 @@ from argparse import Namespace
 from flask import abort, render_template, request, Response, send_from_directory
 from importlib import metadata
 from json import dumps
+from threading import Thread
 from time import time_ns
 from xapblr_web import app
 
 from .utils import get_data_dir
+from xapblr.captions import apply_captions
 from xapblr.utils import fix_date_range
 from xapblr.config import config
+from xapblr.phash import MAX_LOOKUP
 
-from .controllers.clip import clip_offer, clip_accept
+from .controllers.clip import clip_offer, clip_accept, clip_renew, clip_similar
 
 version = metadata.version("xapblr")
 
@@ -44,7 +47,7 @@ def send_static(path):
 @app.route("/search", methods=["POST"])
 def search():
     from xapblr.search import search
-    from xapblr.render import renderers
+    from xapblr.render import prefetch, renderers
     from xapblr.utils import format_timestamp
 
     pagesize = 50
@@ -69,7 +72,9 @@ def search():
     start = time_ns()
     res = search(args)
     out = {"results": [], "meta": res[0]}
-    for m in res[1]:
+    posts = list(res[1])
+    prefetch(args.render, posts)
+    for m in posts:
         m["rendered"] = renderer(m, args)
         [m.pop(k) for k in ["content", "trail", "blog"]]
         m["timestamp_hf"] = format_timestamp(m["timestamp"])
@@ -81,6 +86,29 @@ def search():
     return Response(dumps(out), mimetype="application/json")
 
 
+@app.route("/search/stream", methods=["POST"])
+def search_stream():
+    # Stream all matches of a query as NDJSON, one post per line. Takes the
+    # same JSON body as /search, less the paging and rendering options.
+    from xapblr.search import search_all
+
+    args = Namespace()
+    args.offset = 0
+    args.sort = "newest"
+    for k, v in request.json.items():
+        setattr(args, k, v)
+    args.search = [fix_date_range(request.json["query"])]
+    (meta, chunks) = search_all(args)
+    if "error" in meta.keys():
+        return Response(dumps(meta), status=400, mimetype="application/json")
+
+    def generate():
+        for posts in chunks:
+            yield "".join(dumps(m) + "\n" for m in posts)
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
 def clip_authenticate(token):
     try:
         if token != config["clip"]["auth_token"]:
@@ -106,4 +134,30 @@ def clip_accept_view():
     imgs = data.get("images", None) or abort(400)
     imgs = {i["id"]: i for i in imgs}
     clip_accept(imgs)
+    # Adding captions to the posts can take a while; the response need not wait.
+    Thread(target=apply_captions, daemon=True).start()
     return Response("{}", mimetype="application/json")
+
+
+@app.route("/clip/renew", methods=["POST"])
+def clip_renew_view():
+    data = request.json
+    clip_authenticate(data.get("auth_token", ""))
+
+    lease = data.get("lease", None) or abort(400)
+    n = clip_renew(lease)
+    return Response(dumps({"leased": n}), mimetype="application/json")
+
+
+@app.route("/clip/similar", methods=["POST"])
+def clip_similar_view():
+    data = request.json
+    clip_authenticate(data.get("auth_token", ""))
+
+    hs = data.get("phashes", None)
+    if type(hs) is not list or len(hs) > MAX_LOOKUP:
+        abort(400)
+    if any(type(h) is not int for h in hs):
+        abort(400)
+    captions = clip_similar(hs) if len(hs) > 0 else []
+    return Response(dumps({"captions": captions}), mimetype="application/json")